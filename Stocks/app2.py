@@ -3,35 +3,164 @@ import pandas as pd
 import yfinance as yf
 import numpy as np
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from curl_cffi import requests as curl_requests
+from numba import njit
+from datetime import date, datetime, timedelta
+from pathlib import Path
 
 # --- アプリ設定 ---
 st.set_page_config(layout="wide", page_title="ポートフォリオ分析アプリ")
+JPX_CACHE_PATH = Path.home() / '.cache' / 'jpx_stocks.parquet'
+JPX_CACHE_TTL = 60 * 60 * 24 * 7
+CHART_MAX_POINTS = 1500
+TRADING_DAYS = 252
 
 # --- 株価取得関数 ---
-@st.cache_data
-def get_stock_data(tickers, start_date, end_date):
-    all_data = {}
+@st.cache_resource
+def get_yf_session():
+    return curl_requests.Session(impersonate="chrome")
+
+@st.cache_data(ttl=3600, show_spinner=False, hash_funcs={tuple: hash})
+def get_stock_data(tickers, start_iso, end_iso):
+    start_date = date.fromisoformat(start_iso)
+    try:
+        df = yf.download(list(tickers), start=start_date - timedelta(days=7), end=end_iso, auto_adjust=True, actions=False, threads=True, progress=False, session=get_yf_session())
+    except Exception as e:
+        st.warning(f"株価データの取得に失敗: {e}")
+        return pd.DataFrame()
+    if df.empty:
+        return pd.DataFrame()
+    prices = df['Close']
+    if isinstance(prices, pd.Series):
+        prices = prices.to_frame(name=tickers[0])
+    prices = prices.dropna(axis=1, how='all')
     for ticker in tickers:
-        try:
-            df = yf.download(ticker, start=start_date - timedelta(days=7), end=end_date)
-            if not df.empty:
-                all_data[ticker] = df['Adj Close']
-        except Exception as e:
-            st.warning(f"{ticker} の取得に失敗: {e}")
-    return pd.DataFrame(all_data)
-
-@st.cache_data
+        if ticker not in prices.columns:
+            st.warning(f"{ticker} の取得に失敗")
+    return prices
+
+# 鮮度は parquet の更新時刻で判定し、プロセス内キャッシュは短時間だけ保持する
+@st.cache_resource(ttl=3600, show_spinner=False)
 def get_jp_stock_list():
+    df = _load_jp_stock_list()
+    if df.empty:
+        return df, {}
+    lookup = dict(zip(df['display'], zip(df['code'], df['name'])))
+    return df, lookup
+
+def _load_jp_stock_list():
+    try:
+        if JPX_CACHE_PATH.exists() and time.time() - JPX_CACHE_PATH.stat().st_mtime < JPX_CACHE_TTL:
+            return pd.read_parquet(JPX_CACHE_PATH)
+    except Exception:
+        pass
     try:
         url = 'https://www.jpx.co.jp/markets/statistics-equities/misc/tvdivq0000001vg2-att/data_j.xls'
-        df = pd.read_excel(url, header=2, usecols=['コード', '銘柄名'])
+        df = pd.read_excel(url, header=2, usecols=['コード', '銘柄名'], engine='calamine')
         df.columns = ['code', 'name']
         df['code'] = df['code'].astype(str) + '.T'
         df['display'] = df['name'] + ' (' + df['code'] + ')'
-        return df.dropna()
+        df = df.dropna()
     except:
         return pd.DataFrame()
+    try:
+        JPX_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(JPX_CACHE_PATH)
+    except Exception:
+        pass
+    return df
+
+# 取得済みの info は Ticker 内に保持されるため、成功した銘柄名はここでキャッシュされる
+@st.cache_resource(ttl=60 * 60 * 24 * 7, max_entries=512, show_spinner=False)
+def get_ticker(symbol):
+    return yf.Ticker(symbol, session=get_yf_session())
+
+def get_stock_name(ticker_obj):
+    try:
+        info = ticker_obj.info
+    except Exception:
+        return None
+    if not info:
+        return None
+    return info.get('longName') or info.get('shortName') or ticker_obj.ticker
+
+def fetch_names(tickers):
+    ticker_objs = [get_ticker(t) for t in tickers]
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        names = dict(zip(tickers, ex.map(get_stock_name, ticker_objs)))
+    # 取得に失敗した Ticker は破棄し、次回の分析で再取得する
+    for t, name in names.items():
+        if name is None:
+            get_ticker.clear(t)
+    return names
+
+# --- 計算関数 ---
+# 非有限値の判定を残すため nnan/ninf 以外の fastmath フラグのみ使用
+# error_model='numpy' でゼロ除算を例外ではなく inf/nan にし、下の判定で除外する
+@njit(cache=True, error_model='numpy', fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+def weighted_return_stats(P, w):
+    T, M = P.shape
+    n = 0
+    s = 0.0
+    s2 = 0.0
+    for t in range(1, T):
+        r = 0.0
+        for j in range(M):
+            r += w[j] * (P[t, j] / P[t - 1, j] - 1.0)
+        if not np.isfinite(r):
+            continue
+        n += 1
+        s += r
+        s2 += r * r
+    if n < 2:
+        return np.nan, np.nan
+    mean = s / n
+    var = (s2 - n * mean * mean) / (n - 1)
+    return mean, max(var, 0.0) ** 0.5
+
+# LTTB (Largest-Triangle-Three-Buckets) で描画点数を n_out 点に間引く
+@njit(cache=True)
+def lttb_indices(x, y, n_out):
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0] = 0
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        max_area = -1.0
+        max_j = start
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > max_area:
+                max_area = area
+                max_j = j
+        idx[i + 1] = max_j
+        a = max_j
+    idx[n_out - 1] = n - 1
+    return idx
+
+def compute_analytics(df_prices, weights, initial_total):
+    P = df_prices.to_numpy(dtype=np.float64)
+    # 欠損値の前方補完と先頭欠損の後方補完を1回の gather で行う
+    valid = ~np.isnan(P)
+    rows = np.where(valid, np.arange(P.shape[0])[:, None], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    rows = np.maximum(rows, valid.argmax(axis=0))
+    P = P[rows, np.arange(P.shape[1])]
+    amounts = np.array([weights.get(t, 0.0) for t in df_prices.columns], dtype=np.float64)
+    # 円建ての評価額は float64 で集計する
+    portfolio_value = pd.Series(P @ (amounts / P[0]), index=df_prices.index)
+    mean_daily, std_daily = weighted_return_stats(P, amounts / initial_total)
+    return portfolio_value, mean_daily, std_daily
 
 # --- 初期化 ---
 if 'portfolio' not in st.session_state:
@@ -42,7 +171,7 @@ st.title("📊 ポートフォリオ分析アプリ")
 
 # --- 1. ポートフォリオ設定 ---
 st.header("1. ポートフォリオ設定")
-jp_stocks_df = get_jp_stock_list()
+jp_stocks_df, jp_stocks_lookup = get_jp_stock_list()
 
 # --- 銘柄追加 ---
 st.subheader("銘柄の追加")
@@ -54,8 +183,7 @@ if not jp_stocks_df.empty:
         placeholder="銘柄を選択"
     )
     if selected_stock:
-        ticker = selected_stock.split('(')[-1].replace(')', '')
-        name = ' '.join(selected_stock.split(' ')[:-1])
+        ticker, name = jp_stocks_lookup[selected_stock]
         if ticker not in st.session_state.portfolio:
             st.session_state.portfolio[ticker] = {'name': name, 'invest_amount': None}
             st.rerun()
@@ -68,27 +196,36 @@ with st.form("manual_add", clear_on_submit=True):
     submitted = st.form_submit_button("追加")
     if submitted and ticker_input:
         if ticker_input not in st.session_state.portfolio:
-            try:
-                stock_name = yf.Ticker(ticker_input).info.get('longName', ticker_input)
-            except:
-                stock_name = ticker_input
-            st.session_state.portfolio[ticker_input] = {'name': stock_name, 'invest_amount': None}
+            st.session_state.portfolio[ticker_input] = {'name': ticker_input, 'invest_amount': None}
             st.rerun()
 
 # --- ポートフォリオ表示 ---
+@st.fragment
+def portfolio_editor():
+    new_amounts = {}
+    deleted = None
+    # Enter で先頭行の「削除」が押されないよう Enter 送信を無効化
+    with st.form("amounts_form", enter_to_submit=False):
+        for ticker in tuple(st.session_state.portfolio):
+            detail = st.session_state.portfolio[ticker]
+            col1, col2, col3 = st.columns([5, 3, 1])
+            col1.write(f"**{detail['name']}** ({ticker})")
+            new_amounts[ticker] = col2.number_input("投資金額 (円)", value=detail.get('invest_amount') or 0, step=10000, format="%d", key=f"amount_{ticker}")
+            if col3.form_submit_button("削除", key=f"del_{ticker}"):
+                deleted = ticker
+        submitted = st.form_submit_button("確定")
+    # 送信時に全銘柄の金額をまとめて反映
+    if submitted or deleted:
+        for ticker, amount in new_amounts.items():
+            st.session_state.portfolio[ticker]['invest_amount'] = amount
+        if deleted:
+            del st.session_state.portfolio[deleted]
+        # 分析パネルが古い金額の結果を表示し続けないようアプリ全体を再実行
+        st.rerun()
+
 if st.session_state.portfolio:
     st.subheader("現在のポートフォリオ")
-    for ticker, detail in list(st.session_state.portfolio.items()):
-        col1, col2, col3 = st.columns([5, 3, 1])
-        col1.write(f"**{detail['name']}** ({ticker})")
-        with col2.form(key=f"form_{ticker}"):
-            amount = st.number_input("投資金額 (円)", value=detail.get('invest_amount') or 0, step=10000, format="%d", key=f"amount_{ticker}")
-            if st.form_submit_button("確定"):
-                st.session_state.portfolio[ticker]['invest_amount'] = amount
-                st.rerun()
-        if col3.button("削除", key=f"del_{ticker}"):
-            del st.session_state.portfolio[ticker]
-            st.rerun()
+    portfolio_editor()
 
 # --- 2. 期間設定 ---
 st.header("2. シミュレーション期間設定")
@@ -98,75 +235,120 @@ start_date = col1.date_input("開始日", today - timedelta(days=365))
 end_date = col2.date_input("終了日", today)
 
 # --- 3. 分析実行 ---
-st.header("3. 分析実行")
-if st.button("分析を開始", type="primary", use_container_width=True):
+def render_analysis(result):
+    st.subheader("📈 分析結果")
+    st.dataframe(
+        result['summary'],
+        column_config={
+            "初期投資額": st.column_config.NumberColumn(format="yen"),
+            "最終評価額": st.column_config.NumberColumn(format="yen"),
+            "損益": st.column_config.NumberColumn(format="yen"),
+            "リターン率": st.column_config.NumberColumn(format="%.2f %%")
+        },
+        hide_index=True,
+        use_container_width=True
+    )
+
+    st.subheader("全体サマリー")
+    initial_total = result['initial_total']
+    final_total = result['final_total']
+    pl_total = final_total - initial_total
+    ret_total = (pl_total / initial_total) * 100 if initial_total > 0 else 0
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("初期合計", f"{initial_total:,.0f} 円")
+    col2.metric("最終評価額", f"{final_total:,.0f} 円")
+    col3.metric("損益", f"{pl_total:,.0f} 円", f"{ret_total:.2f} %")
+
+    # --- チャート追加 ---
+    st.subheader("📊 ポートフォリオ評価額の推移")
+    st.plotly_chart(result['fig_performance'], use_container_width=True)
+
+    # リスク・リターン分析
+    st.subheader("📉 ポートフォリオのリスクとリターン")
+    st.write(f"📌 **年間リターン（期待値）:** {result['annual_return']:.2%}")
+    st.write(f"📌 **年間リスク（標準偏差）:** {result['annual_risk']:.2%}")
+    st.write(f"📌 **シャープレシオ:** {result['sharpe_ratio']:.2f}")
+
+@st.fragment
+def analysis_panel(start_date, end_date):
+    clicked = st.button("分析を開始", type="primary", use_container_width=True)
     portfolio = {k: v for k, v in st.session_state.portfolio.items() if v['invest_amount']}
+    key = (tuple(sorted((t, d['invest_amount']) for t, d in portfolio.items())), start_date, end_date)
+    if not clicked:
+        # 入力が前回の分析から変わっていなければ保存済みの結果を再表示
+        last = st.session_state.get('last_analysis')
+        if last is not None and last['key'] == key:
+            render_analysis(last)
+        return
     if not portfolio:
         st.error("投資金額が設定されていません。")
-    else:
-        tickers = list(portfolio.keys())
-        with st.spinner("株価データを取得中..."):
-            df_prices = get_stock_data(tickers, start_date, end_date)
-
-        if df_prices.empty:
-            st.error("株価データが取得できませんでした。")
-        else:
-            # 分析開始
-            st.subheader("📈 分析結果")
-            initial_total = 0
-            final_total = 0
-            summary = []
-            weights = {}
-
-            for ticker, detail in portfolio.items():
-                amount = detail['invest_amount']
-                prices = df_prices[ticker].dropna()
-                if prices.empty:
-                    continue
-                shares = amount / prices.iloc[0]
-                final_value = shares * prices.iloc[-1]
-                pl = final_value - amount
-                ret = (pl / amount) * 100
-                summary.append({
-                    "銘柄": detail['name'],
-                    "初期投資額": f"{amount:,.0f} 円",
-                    "最終評価額": f"{final_value:,.0f} 円",
-                    "損益": f"{pl:,.0f} 円",
-                    "リターン率": f"{ret:.2f} %"
-                })
-                initial_total += amount
-                final_total += final_value
-                weights[ticker] = amount
-
-            if summary:
-                st.dataframe(pd.DataFrame(summary), use_container_width=True)
-
-                st.subheader("全体サマリー")
-                pl_total = final_total - initial_total
-                ret_total = (pl_total / initial_total) * 100 if initial_total > 0 else 0
-
-                col1, col2, col3 = st.columns(3)
-                col1.metric("初期合計", f"{initial_total:,.0f} 円")
-                col2.metric("最終評価額", f"{final_total:,.0f} 円")
-                col3.metric("損益", f"{pl_total:,.0f} 円", f"{ret_total:.2f} %")
-
-                # --- チャート追加 ---
-                st.subheader("📊 ポートフォリオ評価額の推移")
-                weights = {k: v / initial_total for k, v in weights.items()}
-                norm = df_prices / df_prices.iloc[0]
-                portfolio_value = norm.mul(pd.Series(weights)).sum(axis=1) * initial_total
-                st.line_chart(portfolio_value)
-
-                # リスク・リターン分析
-                st.subheader("📉 ポートフォリオのリスクとリターン")
-                daily_returns = df_prices.pct_change().dropna()
-                weighted_returns = daily_returns.mul(pd.Series(weights), axis=1).sum(axis=1)
-                mean_daily = weighted_returns.mean()
-                std_daily = weighted_returns.std()
-                sharpe_ratio = (mean_daily / std_daily) * np.sqrt(252)
-
-                st.write(f"📌 **年間リターン（期待値）:** {mean_daily * 252:.2%}")
-                st.write(f"📌 **年間リスク（標準偏差）:** {std_daily * np.sqrt(252):.2%}")
-                st.write(f"📌 **シャープレシオ:** {sharpe_ratio:.2f}")
-            else:
-                st.warning("分析可能なデータがありません。")
+        return
+
+    tickers = list(portfolio.keys())
+    with st.spinner("株価データを取得中..."):
+        df_prices = get_stock_data(tuple(sorted(tickers)), start_date.isoformat(), end_date.isoformat())
+        # 手動追加銘柄の名称をまとめて補完
+        unresolved = tuple(t for t in tickers if portfolio[t]['name'] == t)
+        if unresolved:
+            for t, name in fetch_names(unresolved).items():
+                if name is not None:
+                    portfolio[t]['name'] = name
+
+    if df_prices.empty:
+        st.error("株価データが取得できませんでした。")
+        return
+    valid_tickers = [t for t in tickers if t in df_prices.columns]
+    if not valid_tickers:
+        st.warning("分析可能なデータがありません。")
+        return
+
+    # 分析開始
+    holdings = pd.DataFrame.from_dict(portfolio, orient='index').loc[valid_tickers]
+    prices = df_prices.to_numpy(dtype=np.float64)[:, df_prices.columns.get_indexer(valid_tickers)]
+    amounts = holdings['invest_amount'].to_numpy(dtype=np.float64)
+    has_price = ~np.isnan(prices)
+    cols = np.arange(prices.shape[1])
+    first_valid = has_price.argmax(axis=0)
+    last_valid = prices.shape[0] - 1 - has_price[::-1].argmax(axis=0)
+    initial_prices = prices[first_valid, cols]
+    final_prices = prices[last_valid, cols]
+    shares = amounts / initial_prices
+    final_values = shares * final_prices
+    pl = final_values - amounts
+    ret = pl / amounts * 100
+    initial_total = amounts.sum()
+    weights = dict(zip(valid_tickers, amounts))
+
+    summary = pd.DataFrame({
+        "銘柄": holdings['name'].to_numpy(),
+        "初期投資額": amounts,
+        "最終評価額": final_values,
+        "損益": pl,
+        "リターン率": ret
+    })
+
+    portfolio_value, mean_daily, std_daily = compute_analytics(df_prices, weights, initial_total)
+    points = lttb_indices(np.arange(len(portfolio_value), dtype=np.float64), portfolio_value.to_numpy(), CHART_MAX_POINTS)
+    chart_value = portfolio_value.iloc[points]
+    fig_performance = go.Figure(go.Scattergl(x=chart_value.index, y=chart_value.to_numpy(), mode='lines', name="評価額"))
+    fig_performance.update_layout(xaxis_title="日付", yaxis_title="評価額 (円)")
+
+    annual_return = mean_daily * TRADING_DAYS
+    annual_risk = std_daily * np.sqrt(TRADING_DAYS)
+    sharpe_ratio = annual_return / annual_risk if annual_risk > 0 else np.nan
+
+    st.session_state.last_analysis = {
+        'key': key,
+        'summary': summary,
+        'initial_total': initial_total,
+        'final_total': final_values.sum(),
+        'fig_performance': fig_performance,
+        'annual_return': annual_return,
+        'annual_risk': annual_risk,
+        'sharpe_ratio': sharpe_ratio
+    }
+    render_analysis(st.session_state.last_analysis)
+
+st.header("3. 分析実行")
+analysis_panel(start_date, end_date)